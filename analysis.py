@@ -2,16 +2,19 @@ import io_utils
 import numpy as np
 from constants import hartree_ev, ev_kcalmol
 import pandas as pd
-import glob
-import json
 import os
+import sys
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 def postprocess_reaction(xtb, react_folder, metadata={}):
     """Extract chemical quantities from a reaction trajectory
 
     Parameters:
     -----------
-    xtb (xtb_utils.xtb_driver instance): xtb driver for optimizing products.
+    xtb (xtb_utils.xtb_driver instance): xtb driver for optimizing products
+    (currently unused, see below).
 
     react_folder (str) : folder storing the reaction data, obtained from the
     reaction_job() routine in react.py.
@@ -22,41 +25,33 @@ def postprocess_reaction(xtb, react_folder, metadata={}):
 
     """
     opt = react_folder + "/opt.xyz"
-    # Get the smiles
-    # TODO: waste of computer time reloading the same file three times...
-    smiles, E = io_utils.traj2smiles(opt,chiral=True)
-    smiles_iso, _ = io_utils.traj2smiles(opt,chiral=False)
-    structs, _ = io_utils.traj2str(opt)
-
-    mols = [smiles[0]]
-    regions = []
-    rstart = 0
-
-    # loop through smiles and detect changes in smiles
-    for si,s in enumerate(smiles):
-        if s == mols[-1]:
-            pass
-        else:
-            mols += [s]
-            regions += [(rstart,si)]
-            rstart = si
-
-    regions += [(rstart, len(smiles))]
-
-    imins = []
-    for start,end in regions:
-        imin = np.argmin(E[start:end]) + start
-        stable = True
-        # Check if imin is a local minima
-        if imin < len(smiles)-1:
-            if E[imin]>E[imin+1]:
-                stable = False
-        if imin > 0:
-            if E[imin]>E[imin-1]:
-                stable = False
-
-        if stable:
-            imins += [imin]
+    # Get the smiles, parsing the trajectory only once
+    structs, E, trajectory = io_utils.parse_traj(opt)
+    smiles = [io_utils.mol2smiles(m, chiral=True) for m in trajectory]
+    smiles_iso = [io_utils.mol2smiles(m, chiral=False) for m in trajectory]
+
+    E = np.asarray(E, dtype=np.float64)
+
+    # detect changes in smiles, which split the trajectory in regions going
+    # from starts[k] to ends[k]
+    smiles_arr = np.array(smiles)
+    change = np.flatnonzero(smiles_arr[1:] != smiles_arr[:-1]) + 1
+    starts = np.r_[0, change]
+    ends = np.r_[change, len(smiles)]
+
+    # lowest energy point of each region: sorting by region and then by
+    # energy puts the minimum of region k at position starts[k]. lexsort is
+    # stable so ties go to the first point, as with argmin.
+    region = np.repeat(np.arange(len(starts)), ends - starts)
+    region_mins = np.lexsort((E, region))[starts]
+
+    # Keep those that are local minima. Neighbours are clamped to the ends of
+    # the trajectory, so that the end points are only compared to one side.
+    before = E[np.maximum(region_mins - 1, 0)]
+    after = E[np.minimum(region_mins + 1, len(E) - 1)]
+    Emins = E[region_mins]
+    is_min = ~((Emins > before) | (Emins > after))
+    imins = region_mins[is_min].tolist()
 
     # Important potential energy surface points
     ipots = [imins[0]]
@@ -67,40 +62,26 @@ def postprocess_reaction(xtb, react_folder, metadata={}):
         imax = np.argmax(E[imins[k-1]:imins[k]]) + imins[k-1]
         # if imax is different from both, we add it to the pot curve too
         if imax != imins[k] and imax != imins[k-1]:
-            ipots += [imax]
-            stable += [False]
-        ipots += [imins[k]]
-        stable += [True]
-
-    # Optimize "stable" structures
-    chiral_smiles = []
-    isomeric_smiles = []
-    energies = []
+            ipots.append(imax)
+            stable.append(False)
+        ipots.append(imins[k])
+        stable.append(True)
+
+    # Save "stable" and transition structures. Note that stable structures
+    # are not re-optimized without constraints: the vtight optimization job
+    # used to be built here but it was never started. The structures,
+    # energies and smiles are the ones already parsed from the trajectory.
     for i, sindex in enumerate(ipots):
         if stable[i]:
             fn = react_folder + "/stable_%4.4i.xyz" % sindex
-            with open(fn, "w") as f:
-                f.write(structs[sindex])
-
-            # optimize the structure without constraints
-            xtb.optimize(fn, fn,
-                         level="vtight")
-
-            # Read back
-            # TODO:again, reloading the same file twice
-            s, eprod = io_utils.traj2smiles(fn, chiral=True, index=0)
-            chiral_smiles += [s]
-            s, _ = io_utils.traj2smiles(fn, chiral=False, index=0)
-            isomeric_smiles += [s]
-            energies += [float(eprod)]
         else:
             fn = react_folder + "/ts_%4.4i.xyz" % sindex
-            with open(fn, "w") as f:
-                f.write(structs[sindex])
+        with open(fn, "w") as f:
+            f.write(structs[sindex])
 
-            chiral_smiles += [smiles[sindex]]
-            isomeric_smiles += [smiles_iso[sindex]]
-            energies +=[float(E[sindex])]
+    chiral_smiles = [smiles[sindex] for sindex in ipots]
+    isomeric_smiles = [smiles_iso[sindex] for sindex in ipots]
+    energies = [float(E[sindex]) for sindex in ipots]
 
     out = {
         "E":energies,
@@ -114,23 +95,39 @@ def postprocess_reaction(xtb, react_folder, metadata={}):
     for key,val in metadata.items():
         out[key] = val
 
-    with open(react_folder + "/reaction_data.json", "w") as f:
-        json.dump(out, f, indent=2, sort_keys=True)
+    io_utils.write_json(out, react_folder + "/reaction_data.json")
 
     return out
 
 def read_all_reactions(output_folder,
                        verbose=True,
                        restart=True,
-                       save=True):
-    """Read and parse all reactions in a given folder."""
-    folders = glob.glob(output_folder + "/reactions/[0-9]*")
+                       save=True,
+                       nthreads=8):
+    """Read and parse all reactions in a given folder.
+
+    Reaction folders are read concurrently by nthreads threads, as this is
+    mostly waiting on the filesystem. If restart is True, pathways saved in
+    results_raw.pkl are not read again unless their reaction_data.json was
+    modified since it was saved, and folders recorded as failed in
+    results_failed.pkl are not read again unless the folder itself was
+    modified since.
+    """
+    try:
+        with os.scandir(output_folder + "/reactions") as it:
+            folders = [e.path for e in it
+                       if e.name[:1].isdigit() and e.is_dir()]
+    except FileNotFoundError:
+        folders = []
     if verbose:
         print("Parsing folder <%s>, with" % output_folder)
         print("   %6i trajectories..." % len(folders))
 
     failed = []
     pathways = []
+    # failed folders, with the modification time of the folder when it was
+    # found to have failed
+    old_failed = pd.Series(dtype=np.float64)
     if restart:
         try:
             old_df = pd.read_pickle(output_folder+"/results_raw.pkl")
@@ -139,39 +136,112 @@ def read_all_reactions(output_folder,
         else:
             if verbose:
                 print(" - %6i trajectories in restart file" % len(old_df))
+        try:
+            old_failed = pd.read_pickle(output_folder+"/results_failed.pkl")
+        except FileNotFoundError:
+            pass
+        else:
+            if len(old_failed) and isinstance(old_failed.iloc[0], str):
+                # older files only list the folders, so they are read again
+                old_failed = pd.Series(np.nan, index=old_failed.values)
     else:
         old_df = pd.DataFrame()
 
-    old_indices = old_df.index
-    new_indices = []
-    for f in folders:
-        # nasty parsing...
-        if f in old_indices:
-            # already in restart file
-            continue
+    def json_mtime(f):
         try:
-            if os.path.exists(f + "/FAILED_FORWARD")\
-               or os.path.exists(f + "/FAILED_BACKWARD"):
-                raise OSError()
-
-            fn = f + "/reaction_data.json"
-            with open(fn,"r") as fin:
-                read_out = json.load(fin)
+            return os.stat(f + "/reaction_data.json").st_mtime
+        except OSError:
+            return np.nan
 
+    def dir_mtime(f):
+        try:
+            return os.stat(f).st_mtime
+        except OSError:
+            return np.nan
+
+    def load_pathway(f):
+        # Returns the pathway data (or None) and, if convergence failed, the
+        # modification time of the folder (or None).
+        # nasty parsing... one listing of the folder tells us everything
+        try:
+            folder_mtime = dir_mtime(f)
+            with os.scandir(f) as it:
+                names = {e.name for e in it}
+            if "FAILED_FORWARD" in names or "FAILED_BACKWARD" in names:
+                # Convergence failed, for good
+                return None, folder_mtime
+
+            # the modification time is taken before reading, so that a file
+            # rewritten in the meantime is read again next time.
+            mtime = json_mtime(f)
+            read_out = io_utils.read_json(f + "/reaction_data.json")
+            read_out["mtime"] = mtime
+            # The same species show up in many pathways. Interning their
+            # SMILES saves memory and makes comparisons between them cheap.
+            for key in ("SMILES_c", "SMILES_i"):
+                read_out[key] = [sys.intern(smi) for smi in read_out[key]]
+            return read_out, None
         except:
-            # Convergence failed
-            failed += [f]
+            # Missing or broken data, maybe the reaction is still running
+            return None, None
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        # drop restart pathways whose data changed on disk (or that were saved
+        # without a modification time), so that they are read again.
+        nstale = 0
+        if len(old_df):
+            mtimes = np.fromiter(pool.map(json_mtime, old_df.index),
+                                 dtype=np.float64, count=len(old_df))
+            if "mtime" in old_df:
+                fresh = old_df["mtime"].values == mtimes
+            else:
+                fresh = np.zeros(len(old_df), dtype=bool)
+            nstale = len(old_df) - np.count_nonzero(fresh)
+            old_df = old_df[fresh]
+            if verbose and nstale:
+                print(" - %6i of those modified since" % nstale)
+
+        # same for failed folders that were modified since
+        nstale_failed = 0
+        if len(old_failed):
+            mtimes = np.fromiter(pool.map(dir_mtime, old_failed.index),
+                                 dtype=np.float64, count=len(old_failed))
+            fresh = old_failed.values == mtimes
+            nstale_failed = len(old_failed) - np.count_nonzero(fresh)
+            old_failed = old_failed[fresh]
+
+        # skip those already in restart files
+        old_indices = set(old_df.index) | set(old_failed.index)
+        todo = [f for f in folders if f not in old_indices]
+        loaded = list(pool.map(load_pathway, todo))
+
+    new_indices = []
+    new_failed = {}
+    for f, (read_out, failed_mtime) in zip(todo, loaded):
+        if read_out is None:
+            failed.append(f)
+            if failed_mtime is not None:
+                new_failed[f] = failed_mtime
         else:
-            new_indices += [f]
-            pathways += [read_out]
+            new_indices.append(f)
+            pathways.append(read_out)
 
 
     if verbose:
-        print(" - %6i that did not converge" % len(failed))
+        print(" - %6i that did not converge"
+              % (len(failed) + np.count_nonzero(old_failed.index.isin(folders))))
         print("--------------")
 
     new = pd.DataFrame(pathways, index=new_indices)
-    data = old_df.append(new)
+    data = pd.concat([old_df, new])
+
+    # Per-point quantities are stored as typed arrays so that the network
+    # analysis can slice and index them directly.
+    if len(data):
+        for col, dtype in (("E", np.float64),
+                           ("is_stable", bool),
+                           ("stretch_points", np.int64)):
+            data[col] = data[col].map(lambda x: np.asarray(x, dtype=dtype))
 
     if verbose:
         if len(old_df):
@@ -181,10 +251,15 @@ def read_all_reactions(output_folder,
             print(" = %6i pathways" % len(pathways))
 
     if save:
-        if len(new):
+        if len(new) or nstale:
             if verbose:
                 print("       ... saving new data ...")
             data.to_pickle(output_folder+"/results_raw.pkl")
+        if len(new_failed) or nstale_failed:
+            all_failed = pd.concat([old_failed,
+                                    pd.Series(new_failed, dtype=np.float64)])
+            all_failed.astype(np.float64).sort_index().to_pickle(
+                output_folder+"/results_failed.pkl")
 
     if verbose:
         print("                                      done.")
@@ -196,40 +271,75 @@ def get_species_table(pathways, verbose=True, resolve_chiral=False):
         print("\nBuilding table of chemical species, from")
         print("   %6i reaction pathways" % len(pathways))
 
-    species = {}
-    for irow, row in pathways.iterrows():
-        for k in range(len(row.is_stable)):
-            if row.is_stable[k]:
-                if resolve_chiral:
-                    smi = row.SMILES_c[k]
-                else:
-                    smi = row.SMILES_i[k]
-
-                if smi in species:
-                    if row.E[k] < species[smi]['E']:
-                        species[smi] = {
-                            'smiles':smi,
-                            'E':row.E[k],
-                            'file':row.folder + "stable_%4.4i.xyz" % row.stretch_points[k],
-                            'position':row.stretch_points[k]}
-                else:
-                    species[smi] = {
-                        'smiles':smi,
-                        'E':row.E[k],
-                        'file':row.folder + "stable_%4.4i.xyz" % row.stretch_points[k],
-                        'position':row.stretch_points[k]}
-
-    k,v = zip(*species.items())
-    out = pd.DataFrame(v).sort_values('E').set_index('smiles')
+    if resolve_chiral:
+        chemical_id = "SMILES_c"
+    else:
+        chemical_id = "SMILES_i"
+
+    # Flatten pathways to one row per point
+    npoints = pathways.is_stable.map(len).values
+    points = pd.DataFrame({
+        'smiles':list(itertools.chain.from_iterable(pathways[chemical_id])),
+        'E':np.concatenate(pathways.E.values),
+        'folder':np.repeat(pathways.folder.values, npoints),
+        'position':np.concatenate(pathways.stretch_points.values),
+        'stable':np.concatenate(pathways.is_stable.values).astype(bool)})
+
+    # Lowest energy stable point of each species. The sort is stable so that
+    # ties go to the first pathway.
+    out = points[points.stable].sort_values('E', kind='stable')
+    out = out.drop_duplicates('smiles', keep='first')
+    # same as the "stable_%4.4i.xyz" files written by postprocess_reaction
+    out['file'] = (out.folder + "stable_"
+                   + out.position.astype(str).str.zfill(4) + ".xyz")
+    out = out[['smiles', 'E', 'file', 'position']].set_index('smiles')
+
     if verbose:
         print("   %6i stable-ish species found" % len(out))
-        evspan = (out.E.max() - out.E.min()) * hartree_ev
+        # out is sorted by energy
+        evspan = (out.E.iloc[-1] - out.E.iloc[0]) * hartree_ev
         print("          with energies spanning %3.1f eV" % (evspan))
         print("          saving structures...")
         print("                                      done.")
 
     return out
 
+def transition_states(E, i):
+    """Find the transition states between point i and every other point.
+
+    Parameters:
+    -----------
+    E (np.ndarray) : energies along a pathway.
+
+    i (int) : index of the starting point.
+
+    Returns:
+    --------
+    j (np.ndarray) : indices of the end points, going forward from i+1 to the
+    last point and then backward from i-1 to the first point.
+
+    tspos (np.ndarray) : for each j, the position of the maximum of E[i:j]
+    (forward) or E[j:i] (backward). Ties go to the first point, as with
+    np.argmax.
+    """
+    n = len(E)
+    # Forward, the window E[i:j] grows to the right so a running argmax is
+    # only updated on a strictly new maximum.
+    Ef = E[i:n-1]
+    Mf = np.maximum.accumulate(Ef)
+    new_max = Ef > np.r_[-np.inf, Mf[:-1]]
+    tsf = i + np.maximum.accumulate(np.where(new_max, np.arange(len(Ef)), 0))
+
+    # Backward, the window E[j:i] grows to the left so ties move the argmax
+    # to the new point.
+    Eb = E[:i][::-1]
+    Mb = np.maximum.accumulate(Eb)
+    new_max = Eb >= np.r_[-np.inf, Mb[:-1]]
+    tsb = i - 1 - np.maximum.accumulate(np.where(new_max, np.arange(len(Eb)), 0))
+
+    j = np.r_[np.arange(i+1, n), np.arange(i-1, -1, -1)]
+    return j, np.r_[tsf, tsb]
+
 def reaction_network_layer(pathways, reactant, species,
                            exclude=[],
                            resolve_chiral=False):
@@ -243,65 +353,44 @@ def reaction_network_layer(pathways, reactant, species,
     local_dE = []
     Ereactant = species.E.loc[reactant]
 
-    for k, rowk in pathways.iterrows():
+    for rowk in pathways.itertuples():
         if resolve_chiral:
             smiles = rowk.SMILES_c
         else:
             smiles = rowk.SMILES_i
-        if reactant in smiles:
+        # a single scan of the pathway for the reactant
+        try:
             i = smiles.index(reactant)
-            E = rowk.E
-            stable = rowk.is_stable
-
-            # forward
-            for j in range(i+1, len(stable)):
-                if stable[j] and smiles[j] not in exclude:
-                    # we have a stable -> stable reaction
-
-                    # Get transition state
-                    tspos = np.argmax(E[i:j]) + i
-                    ts = E[tspos]
-                    # TODO: Major issue. Some trajectories are completely
-                    # messed up and don't have a barrier at all. We get rid of
-                    # these artifically here.
-                    if ts <= E[i] or ts <= E[j]:
-                        continue
-                    ts_E += [ts]
-                    product = smiles[j]
-                    Eproducts = species.E.loc[product]
-                    to_smiles += [product]
-                    dE += [Eproducts - Ereactant]
-                    local_dE += [E[j] - E[i]]
-                    ts_i += [rowk.stretch_points[tspos]]
-
-                    folder += [rowk.folder]
-                    mtdi += [rowk.mtdi]
-                    barrier += [E[tspos]-E[i]]
-
-            for j in range(i-1, -1, -1):
-                if stable[j] and smiles[j] not in exclude:
-                    # do the same but in the other direction
-
-                    # Get transition state
-                    tspos = np.argmax(E[j:i]) + j
-                    ts = E[tspos]
-                    # TODO: Major issue. Some trajectories are completely
-                    # messed up and don't have a barrier at all. We get rid of
-                    # these artifically here.
-                    if ts <= E[i] or ts <= E[j]:
-                        continue
-
-                    ts_E += [ts]
-                    product = smiles[j]
-                    Eproducts = species.E.loc[product]
-                    to_smiles += [product]
-                    dE += [Eproducts - Ereactant]
-                    local_dE += [E[j] - E[i]]
-                    ts_i += [rowk.stretch_points[tspos]]
-
-                    folder += [rowk.folder]
-                    mtdi += [rowk.mtdi]
-                    barrier += [E[tspos]-E[i]]
+        except ValueError:
+            continue
+
+        E = np.asarray(rowk.E, dtype=np.float64)
+        stable = rowk.is_stable
+
+        # stable -> stable reactions forward and backward from i, along
+        # with their transition states
+        j, tspos = transition_states(E, i)
+        keep = np.array([stable[jj] and smiles[jj] not in exclude
+                         for jj in j], dtype=bool)
+        ts = E[tspos]
+        # TODO: Major issue. Some trajectories are completely
+        # messed up and don't have a barrier at all. We get rid of
+        # these artifically here.
+        keep &= ~((ts <= E[i]) | (ts <= E[j]))
+        j = j[keep]
+        tspos = tspos[keep]
+
+        products = [smiles[jj] for jj in j]
+        Eproducts = species.E.loc[products].values
+        to_smiles += products
+        ts_E += E[tspos].tolist()
+        dE += (Eproducts - Ereactant).tolist()
+        local_dE += (E[j] - E[i]).tolist()
+        ts_i += np.asarray(rowk.stretch_points)[tspos].tolist()
+
+        folder += [rowk.folder] * len(j)
+        mtdi += [rowk.mtdi] * len(j)
+        barrier += (E[tspos] - E[i]).tolist()
 
     out = pd.DataFrame({
         'from':[reactant] * len(to_smiles),
@@ -327,34 +416,35 @@ def analyse_reaction_network(pathways, species, reactants, verbose=True,
     if verbose:
         print("\nReaction network analysis")
 
-    todo = reactants[:]
-    done = []
+    # breadth-first search, with sets for fast membership checks
+    todo = deque(reactants)
+    todo_set = set(reactants)
+    done = set()
 
     layerind = 1
     while todo:
-        current = todo.pop(0)
+        current = todo.popleft()
+        todo_set.discard(current)
         layer = reaction_network_layer(pathways, current, species,
-                                       exclude=done + [current],
+                                       exclude=done | {current},
                                        resolve_chiral=resolve_chiral)
         E0 = species.loc[current].E
-        products = list(set(layer.to))
         if sort_by_barrier:
             if reaction_local:
-                products = sorted(products,
-                                  key=lambda x:layer[layer.to==x].barrier.min())
+                key = "barrier"
             else:
-                products = sorted(products,
-                                  key=lambda x:layer[layer.to==x].E_TS.min())
+                key = "E_TS"
         else:
             if reaction_local:
-                products = sorted(products,
-                                  key=lambda x:layer[layer.to==x].local_dE.min())
+                key = "local_dE"
             else:
-                products = sorted(products,
-                                  key=lambda x:layer[layer.to==x].dE.min())
+                key = "dE"
+        products = layer.groupby("to")[key].min().sort_values(kind="stable")
+        products = products.index.tolist()
+        reacts_by_product = dict(list(layer.groupby("to")))
 
         if len(products) == 0:
-            done += [current]
+            done.add(current)
             continue
 
         if verbose:
@@ -365,7 +455,7 @@ def analyse_reaction_network(pathways, species, reactants, verbose=True,
         for p in products:
             if verbose:
                 print("  → %s" % p)
-            reacts = layer[layer.to == p]
+            reacts = reacts_by_product[p]
 
             if reaction_local:
                 best = reacts.loc[reacts.barrier.idxmin()]
@@ -386,7 +476,7 @@ def analyse_reaction_network(pathways, species, reactants, verbose=True,
                 print("           %s" % best.folder)
                 print("           + %5i similar pathways\n" % (len(reacts)-1))
 
-            final_reactions += [
+            final_reactions.append(
                 {'from':current, 'to':p,
                  'dE':dE,
                  'dE_TS':TS,
@@ -394,12 +484,13 @@ def analyse_reaction_network(pathways, species, reactants, verbose=True,
                  'TS_index':best.i_TS,
                  'mtdi':best.mtdi,
                 }
-            ]
+            )
 
-            if (not p in done) and (not p in todo):
-                todo += [p]
+            if (not p in done) and (not p in todo_set):
+                todo.append(p)
+                todo_set.add(p)
 
-        done += [current]
+        done.add(current)
         layerind += 1
 
     final_reactions = pd.DataFrame(final_reactions)
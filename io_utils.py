@@ -7,10 +7,22 @@ try:
 except ModuleNotFoundError:
     import openbabel.pybel as pybel
 import subprocess
+import functools
 import re
+import json
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
 
 def metadata():
-    # Return a dictionary with some metadata to improve reproducibility
+    # Return a dictionary with some metadata to improve reproducibility. The
+    # values can't change during a run, so the subprocesses are only run
+    # once, and every caller gets its own copy to modify.
+    return dict(_metadata())
+
+@functools.lru_cache(maxsize=None)
+def _metadata():
     xtbv = subprocess.check_output(["xtb", "--version"],
                                    stderr=subprocess.DEVNULL).strip().decode()
     for line in xtbv.split("\n"):
@@ -24,6 +36,44 @@ def metadata():
             ["git", "describe", "--always"],
             cwd=os.path.dirname(__file__)).strip().decode()}
 
+# =================== json reading/writing routines ============================
+def read_json(filepath):
+    """Read a json file, using orjson if it is available."""
+    if orjson:
+        with open(filepath, "rb") as f:
+            return orjson.loads(f.read())
+    else:
+        with open(filepath, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+def nan_to_null(obj):
+    """Replace NaN floats in nested dicts and lists by None."""
+    if isinstance(obj, float):
+        return None if obj != obj else obj
+    if isinstance(obj, dict):
+        return {key:nan_to_null(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [nan_to_null(val) for val in obj]
+    return obj
+
+def write_json(obj, filepath):
+    """Write obj to a json file (indented, sorted keys, UTF-8), using orjson if
+    it is available.
+
+    NaN is not valid json, so NaN floats (for example energies that could not
+    be parsed) are written as null by both writers. read_all_reactions() reads
+    them back as NaN. Apart from that, the two writers only differ in how they
+    format some floats (1e-7 vs 1e-07), which read back to the same values.
+    """
+    if orjson:
+        with open(filepath, "wb") as f:
+            f.write(orjson.dumps(obj,
+                                 option=orjson.OPT_INDENT_2|orjson.OPT_SORT_KEYS))
+    else:
+        with open(filepath, "w", encoding="utf-8") as f:
+            json.dump(nan_to_null(obj), f, indent=2, sort_keys=True,
+                      ensure_ascii=False, allow_nan=False)
+
 # =================== xTB output  reading/writing routines =====================
 def read_wbo(filepath):
     bonds = []
@@ -99,60 +149,81 @@ def read_xtb_hessian(file):
 
 
 # =================== xyz trajectory files reading/writing routines =============================
+def read_frames(f):
+    """Iterate over the structures of an open xyz trajectory file.
+
+    Frames are read one at a time from the current position of f and yielded
+    as (structure, energy) tuples.
+    """
+    while True:
+        first_line = f.readline()
+        # EOF -> blank line
+        if not first_line:
+            return
+
+        natoms = int(first_line.rstrip())
+        comment_line = f.readline()
+        lines = [first_line, comment_line]
+        lines += [f.readline() for i in range(natoms)]
+        yield "".join(lines), comment_line_energy(comment_line)
+
 def traj2str(filepath, index=None, as_list=False):
     """Read an xyz file containing a trajectory."""
     structures = []
     energies = []
-    k = 0
     with open(filepath, 'r') as f:
-        while True:
-            first_line = f.readline()
-            # EOF -> blank line
-            if not first_line:
-                break
-
-            this_mol = first_line
-            natoms = int(first_line.rstrip())
-
-            comment_line = f.readline()
-            this_mol += comment_line
-            E = comment_line_energy(comment_line)
-
-            for i in range(natoms):
-                this_mol += f.readline()
-
+        for k, (this_mol, E) in enumerate(read_frames(f)):
             if index is None:
-                structures += [this_mol]
-                energies += [E]
-            else:
-                if k == index:
-                    if as_list:
-                        return [this_mol], [E]
-                    else:
-                        return this_mol, E
-
-            k+=1
+                structures.append(this_mol)
+                energies.append(E)
+            elif k == index:
+                if as_list:
+                    return [this_mol], [E]
+                else:
+                    return this_mol, E
     return structures,energies
 
+def iter_structures(filepaths):
+    """Iterate over the structures in a sequence of xyz trajectory files.
+
+    Files are opened one at a time and structures are yielded as they are
+    read, so that the trajectories never need to be loaded all at once.
+    """
+    for filepath in filepaths:
+        with open(filepath, 'r') as f:
+            for this_mol, E in read_frames(f):
+                yield this_mol
+
 def traj2smiles(filepath, index=None, chiral=False):
     """Read an xyz file and convert to a list of SMILES ."""
     # Read the trajectory
     strs, E = traj2str(filepath, index=index, as_list=True)
     output = []
 
-    if chiral:
-        flags = {"c":1,"n":1}
-    else:
-        flags = {"c":1,"n":1, "i":1}
     for s in strs:
         # put string in lowercase to fix stupid openbabel bug
-        output+= [pybel.readstring("xyz", s.lower()).write(format="smi", opt=flags).rstrip()]
+        output+= [mol2smiles(pybel.readstring("xyz", s.lower()), chiral=chiral)]
 
     if index is None:
         return output, E
     else:
         return output[0], E[0]
 
+def parse_traj(filepath):
+    """Read an xyz file once into structures, energies and pybel molecules."""
+    strs, E = traj2str(filepath)
+    # put string in lowercase to fix stupid openbabel bug
+    mols = [pybel.readstring("xyz", s.lower()) for s in strs]
+    return strs, E, mols
+
+def mol2smiles(mol, chiral=False):
+    """Convert a pybel molecule to a canonical SMILES string."""
+    if chiral:
+        flags = {"c":1,"n":1}
+    else:
+        flags = {"c":1,"n":1, "i":1}
+    return mol.write(format="smi", opt=flags).rstrip()
+
 def traj2mols(filepath, index=None):
     """Read an xyz file and convert to a list of OBMol objects."""
     # Read the trajectory
@@ -1,12 +1,14 @@
 from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import functools
 import react_utils
-from io_utils import traj2str, read_xtb_hessian
+import io_utils
+from io_utils import traj2str, read_frames, read_xtb_hessian
 import shutil
 import numpy as np
 from math import inf
 import os
-from glob import glob
-import tempfile
+import io
 from constants import hartree_ev, ev_kcalmol
 
 """
@@ -15,6 +17,18 @@ react_utils.
 """
 
 
+def pool_driver(xtb_driver, nthreads):
+    """Driver for the jobs submitted to a pool of nthreads workers.
+
+    When more than one xtb process runs at a time, each of them gets a single
+    thread to avoid oversubscribing the cpus. Serial xtb runs should keep using
+    xtb_driver itself.
+    """
+    if nthreads > 1:
+        return xtb_driver.with_threads(1)
+    return xtb_driver
+
+
 def generate_initial_structures(xtb_driver,
                                 workdir,
                                 guess_xyz_file,
@@ -30,7 +44,8 @@ def generate_initial_structures(xtb_driver,
             print("-----------------------------------------------------------------")
             print("Skipping initial conformer generation")
         shutil.copyfile(guess_xyz_file, outputdir + "/init_mtd.xyz")
-        return
+        structures, E = traj2str(outputdir + "/init_mtd.xyz")
+        return structures
 
     if verbose:
         print("-----------------------------------------------------------------")
@@ -77,17 +92,21 @@ def generate_initial_structures(xtb_driver,
         structures, E= traj2str(outputdir + "/init_mtd.xyz")
 
     print("   done! %i starting structures" % len(structures))
-
+    return structures
 
 def select_initial_structures(xtb_driver,
                               workdir, guess_xyz,
                               atoms, low,high,npts,
                               parameters,
                               nthreads=1,
-                              verbose=True):
+                              verbose=True,
+                              structures=None):
 
     outputdir = workdir + "/init"
-    structures, E= traj2str(outputdir + "/init_mtd.xyz")
+    # structures returned by generate_initial_structures() can be passed
+    # directly, otherwise they are read back from init_mtd.xyz.
+    if structures is None:
+        structures, E= traj2str(outputdir + "/init_mtd.xyz")
     if verbose:
         print("Refining initial structures...")
 
@@ -100,7 +119,9 @@ def select_initial_structures(xtb_driver,
 
     # load structures
     if parameters["mtd_indices"]:
-        mtd_indices = parameters["mtd_indices"]
+        # Repeated indices would overwrite each other's metadynamics output
+        mtd_indices = np.unique(
+            np.asarray(parameters["mtd_indices"], dtype=np.int64)).tolist()
     else:
         if "mtd_lims" in parameters:
             print("warning: mtd_lims deprecated for mtd_limits")
@@ -110,7 +131,7 @@ def select_initial_structures(xtb_driver,
         istart = int(np.floor(flow * npts))
         iend = int(np.floor(fhigh * npts))
         istep = parameters["mtd_step"]
-        mtd_indices = list(np.arange(istart,iend,istep))
+        mtd_indices = np.arange(istart,iend,istep).tolist()
 
     # We take a lower energy fraction of the generated initial structures.
     m = int(max(len(structures) * parameters["imtd_proportion"], 1))
@@ -121,7 +142,7 @@ def select_initial_structures(xtb_driver,
     print("\n")
     print("Metadynamics seed structures (N=%i)" % len(mtd_indices))
     print(" i   |    E(0)   |    E(i)   |  ΔE (kcal/mol)")
-    pts = np.linspace(low,high,npts)
+    pts = react_utils.driving_points(low,high,npts)
     curr = 0
 
     # todo: parallelize here
@@ -175,12 +196,13 @@ def metadynamics_search(xtb_driver,
         print("with %i threads. Working..." % nthreads)
 
 
+    pool_xtb = pool_driver(xtb_driver, nthreads)
     with ThreadPoolExecutor(max_workers=nthreads) as pool:
         futures = []
 
         for mtd_index in mtd_indices:
             mtd_jobs = react_utils.metadynamics_jobs(
-                xtb_driver, mtd_index,
+                pool_xtb, mtd_index,
                 atoms, low, high, npts,
                 workdir +"/init", workdir + "/metadyn", parameters)
 
@@ -210,16 +232,23 @@ def metadynamics_refine(xtb_driver,
     os.makedirs(refined_dir, exist_ok=True)
 
     for mtd_index in mtd_indices:
-        structures = []
-        Es = []
-        for file in glob(mtd_dir + "/mtd%4.4i_*.xyz"%mtd_index):
-            structs, E = traj2str(file)
-            structures += structs
-            Es += E
+        # Structures are streamed from the trajectories straight into the
+        # optimization pool.
+        prefix = "mtd%4.4i_" % mtd_index
+        with os.scandir(mtd_dir) as it:
+            files = sorted(e.path for e in it
+                           if e.name.startswith(prefix)
+                           and e.name.endswith(".xyz"))
+        structures = io_utils.iter_structures(files)
+        dedup_tol = parameters.get("mtd_dedup_tol", 0)
+        if dedup_tol:
+            # Near-duplicates would be removed by CREGEN anyway, so we avoid
+            # optimizing them in the first place.
+            structures = react_utils.unique_structures(structures, dedup_tol)
 
         if verbose:
-            print("MTD%i>\tloaded %i structures, optimizing 📐..."
-                  %(mtd_index, len(structures)))
+            print("MTD%i>\tloading %i trajectories, optimizing 📐..."
+                  %(mtd_index, len(files)))
 
         refined, Eref = refine_structures(
             xtb_driver, mtd_index,
@@ -229,10 +258,8 @@ def metadynamics_refine(xtb_driver,
             nthreads=nthreads)
 
         fn = refined_dir + "/mtd%4.4i.xyz" % mtd_index
-        f = open(fn, "w")
-        for s in refined:
-            f.write(s)
-        f.close()
+        with open(fn, "w") as f:
+            f.writelines(refined)
 
         if verbose:
             print("  → %i structures selected for reactions 🔥" % len(refined))
@@ -244,28 +271,40 @@ def refine_structures(xtb, imtd,
                       verbose=True, nthreads=1):
 
     # make the constraints
-    points = np.linspace(low,high,npts)
+    points = react_utils.driving_points(low,high,npts)
+
+    # Every structure is optimized with the same level and constraints, so we
+    # build those once. The optimizations themselves are xtb subprocesses, and
+    # threads are enough to keep them all busy.
+    opt_job = functools.partial(
+        react_utils.quick_opt_job,
+        pool_driver(xtb, nthreads),
+        level=parameters["optcregen"],
+        xcontrol=dict(wall=parameters["wall"],
+                      constrain = react_utils.make_constraint(
+                          atoms, points[imtd], parameters["force"])))
 
     with ThreadPoolExecutor(max_workers=nthreads) as pool:
-        futures = []
-        for s in structures:
-            future = pool.submit(
-                react_utils.quick_opt_job,
-                xtb, s, parameters["optcregen"],
-                dict(wall=parameters["wall"],
-                     constrain = react_utils.make_constraint(
-                         atoms, points[imtd], parameters["force"])
-                ))
-            futures += [future]
-
         converged = []
         errors = []
-        for f in futures:
+        def collect(f):
             exc = f.exception()
             if exc:
-                errors += [f]
+                errors.append(f)
             else:
-                converged += [f.result()]
+                converged.append(f.result())
+
+        # Only a couple of jobs per thread are queued at any time, so that
+        # structures are read from the trajectories as they are needed
+        # instead of all being held by pending jobs. Results are collected
+        # in submission order.
+        pending = deque()
+        for s in structures:
+            pending.append(pool.submit(opt_job, s))
+            if len(pending) > 2 * nthreads:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
 
         if verbose:
             print("        converged 👍: %i"% len(converged))
@@ -288,27 +327,23 @@ def refine_structures(xtb, imtd,
         structures = []
         energies = []
         for mols in [set_newstable, set_unstable]:
-            with tempfile.NamedTemporaryFile(suffix=".xyz", dir=xtb.scratchdir) as T:
-                for s,E in mols:
-                    T.write(bytes(s, 'ascii'))
-                T.flush()
-
-                if reference is None:
-                    ref = T.name
-                else:
-                    ref = reference
-
-                # Run CREGEN on temp file
-                cre = xtb.cregen(ref,
-                                        T.name, T.name,
-                                        ewin=parameters["emax_local"],
-                                        rthr=parameters["rthr"],
-                                        ethr=parameters["ethr"],
-                                        bthr=parameters["bthr"])
-                error = cre()
-                s, E = traj2str(T.name)
-                structures += s
-                energies += E
+            ensemble = "".join(s for s,E in mols)
+
+            # Run CREGEN on the ensemble, which is written directly to the
+            # run directory. If CREGEN fails, we keep the whole ensemble.
+            cre = xtb.cregen(reference,
+                             "ensemble.xyz", None,
+                             ewin=parameters["emax_local"],
+                             rthr=parameters["rthr"],
+                             ethr=parameters["ethr"],
+                             bthr=parameters["bthr"],
+                             ensemble_string=ensemble)
+            error = cre()
+            if cre.output is not None:
+                ensemble = cre.output
+            for s, E in read_frames(io.StringIO(ensemble)):
+                structures.append(s)
+                energies.append(E)
 
         out_structures = []
         out_energies = []
@@ -375,13 +410,14 @@ def react(xtb_driver,
 
     nreact = 0
     os.makedirs(workdir + "/reactions/")
+    pool_xtb = pool_driver(xtb_driver, nthreads)
     with ThreadPoolExecutor(max_workers=nthreads) as pool:
         futures = []
 
         for mtd_index, structure in worklist:
             futures += [pool.submit(
                 react_utils.reaction_job(
-                    xtb_driver,
+                    pool_xtb,
                     structure,
                     mtd_index,
                     atoms, low, high, npts,
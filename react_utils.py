@@ -1,21 +1,27 @@
 import os
-import shutil
 import subprocess
 import numpy as np
-import tempfile
+import io
 import re
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from analysis import postprocess_reaction
-from io_utils import traj2str
+from io_utils import traj2str, read_frames, xyz2numpy
+from scipy.spatial.distance import pdist
 
 # ------------------- utility routines -----------------------------------#
 def dump_succ_opt(output_folder, structures, energies,
                   split=False):
 
     os.makedirs(output_folder, exist_ok=True)
+    if split:
+        # structures may be any iterable, and we go through it twice
+        structures = list(structures)
+
     # Dump the optimized structures in one file
     with open(output_folder + "/opt.xyz", "w") as f:
-        for s in structures:
-            f.write(s)
+        f.writelines(structures)
 
     if split:
         # Also dump the optimized structures in many files
@@ -24,30 +30,91 @@ def dump_succ_opt(output_folder, structures, energies,
                 f.write(s)
 
 def quick_opt_job(xtb, xyz, level, xcontrol):
-    # TODO comment
-    with tempfile.NamedTemporaryFile(suffix=".xyz",
-                                     dir=xtb.scratchdir) as T:
-        T.write(bytes(xyz, 'ascii'))
-        T.flush()
-        opt = xtb.optimize(T.name,
-                           T.name,
-                           level=level,
-                           xcontrol=xcontrol)
-        opt()
-        xyz, E = traj2str(T.name, 0)
-    return xyz, E
+    # Optimize the xyz string and return the optimized structure and energy.
+    # The geometry goes straight into the xtb run directory and the result is
+    # read back from there, so no scratch files are needed. As before, a
+    # failed optimization returns the unoptimized input.
+    opt = xtb.optimize("quick.xyz", None,
+                       geom_string=xyz,
+                       level=level,
+                       xcontrol=xcontrol)
+    opt()
+    if opt.output is not None:
+        xyz = opt.output
+    return next(read_frames(io.StringIO(xyz)))
+
+def fingerprint(xyz):
+    """Interatomic distances of a structure given as an xyz string.
+
+    The distances are taken in atom order, so that only structures sharing
+    the same atom order (such as the frames of a metadynamics trajectory) can
+    be compared. They are invariant to rotations and translations, and are
+    used to spot duplicate structures without any xtb calculation.
+    """
+    at, pos = xyz2numpy(xyz)
+    return pdist(pos)
+
+def unique_structures(structures, tol):
+    """Iterate over structures, skipping near-duplicates.
+
+    A structure is skipped if every interatomic distance is within tol (in
+    angstrom) of the same distance in a structure already seen. The first
+    structure of each such group is kept. All structures must have the same
+    atom order. Distances do not change under reflection, so mirror images
+    are considered duplicates.
+    """
+    # Fingerprints of the kept structures are stored in the first nkept rows
+    # of an array that doubles in size when full, along with a short summary
+    # (mean, smallest and largest distance) of each.
+    kept = None
+    summaries = None
+    nkept = 0
+    for s in structures:
+        fp = fingerprint(s)
+        summary = np.array([fp.mean(), fp.min(), fp.max()])
+        if nkept:
+            # Two fingerprints can only match if their summaries agree within
+            # tol, which is a cheap way to find the few candidates to compare.
+            close = np.flatnonzero(np.all(
+                np.abs(summaries[:nkept] - summary) < tol, axis=1))
+            if len(close) and np.any(
+                    np.max(np.abs(kept[close] - fp), axis=1) < tol):
+                continue
+        if kept is None:
+            kept = np.empty((64, len(fp)))
+            summaries = np.empty((64, len(summary)))
+        elif nkept == len(kept):
+            kept = np.concatenate([kept, np.empty_like(kept)])
+            summaries = np.concatenate([summaries, np.empty_like(summaries)])
+        kept[nkept] = fp
+        summaries[nkept] = summary
+        nkept += 1
+        yield s
+
+@functools.lru_cache(maxsize=None)
+def driving_points(low, high, npts):
+    """Values of the driving coordinate along the search.
+
+    The same points are needed by every metadynamics and reaction job of a
+    search, so they are computed once and shared. The returned array is
+    read-only for that reason.
+    """
+    points = np.linspace(low, high, npts)
+    points.setflags(write=False)
+    return points
+
+# $constrain entries for the driven coordinate, by number of atoms
+constraint_formats = {2: "distance: %i, %i, %f",
+                      3: "angle: %i, %i, %i, %f",
+                      4: "dihedral: %i, %i, %i, %i, %f"}
 
 def make_constraint(atoms, val, force):
-    if len(atoms) == 2:
-        return ("force constant=%f" % force,
-                "distance: %i, %i, %f" % (atoms[0], atoms[1], val))
-    if len(atoms) == 3:
-        return ("force constant=%f" % force,
-                "angle: %i, %i, %i, %f" % (atoms[0], atoms[1], atoms[2], val))
-    if len(atoms) == 4:
-        return ("force constant=%f" % force,
-                "dihedral: %i, %i, %i, %i, %f" % (atoms[0], atoms[1],
-                                               atoms[2], atoms[3], val))
+    try:
+        fmt = constraint_formats[len(atoms)]
+    except KeyError:
+        return None
+    return ("force constant=%f" % force,
+            fmt % (*atoms, val))
 
 # ------------------------------------------------------------------------------#
 def stretch(xtb, initial_xyz,
@@ -85,15 +152,14 @@ def stretch(xtb, initial_xyz,
 
     energies : list of floats of xtb energies (in Hartrees) for the structures.
 
-    """
-    # Make scratch files
-    fdc, current = tempfile.mkstemp(suffix=".xyz", dir=xtb.scratchdir)
-
-    # prepare the current file
-    shutil.copyfile(initial_xyz, current)
+    If the scan fails, the structure and energy in initial_xyz are returned
+    instead.
 
-    opt = xtb.optimize(current,
-                       current,
+    """
+    # The scan trajectory is read straight from the xtb run directory, so we
+    # need no scratch file of our own.
+    opt = xtb.optimize(initial_xyz,
+                       None,
                        failout=failout,
                        level=parameters["optim"],
                        xcontrol=dict(
@@ -103,15 +169,21 @@ def stretch(xtb, initial_xyz,
                            scan=("1: %f, %f, %i" % (low, high, npts),)))
 
     error = opt()
-    structs, energies = traj2str(current)
+    if opt.output is None:
+        # The scan failed: fall back to the initial structure, so that
+        # callers always get at least one point.
+        structs, energies = traj2str(initial_xyz)
+    else:
+        structs = []
+        energies = []
+        for s, E in read_frames(io.StringIO(opt.output)):
+            structs.append(s)
+            energies.append(E)
 
     if verbose:
         for k, E in enumerate(energies):
             print("   👣=%4i    energy💡= %9.5f Eₕ"%(k, E))
 
-    # Got to make sure that you close the filehandles!
-    os.close(fdc)
-    os.remove(current)
     return structs, energies
 
 def metadynamics_jobs(xtb,
@@ -162,8 +234,9 @@ def metadynamics_jobs(xtb,
         Natoms = int(f.readline())
     md = parameters["tsmtd_md"] + ["time=%f" % (parameters["tsmtd_time_per_atom"] * Natoms)]
 
-    # stretch points
-    points = np.linspace(low, high, npts)
+    # stretch points. All the jobs share the same constraint.
+    points = driving_points(low, high, npts)
+    constraint = make_constraint(atoms, points[mtd_index], parameters["force"])
 
     for metadyn_job, metadyn_params in enumerate(parameters["tsmtd_params"]):
         outp = output_folder + "/mtd%4.4i_%2.2i.xyz" % (mtd_index,metadyn_job)
@@ -175,9 +248,7 @@ def metadynamics_jobs(xtb,
                             wall=parameters["wall"],
                             metadyn=metadyn_params,
                             md=md,
-                            constrain=make_constraint(atoms,
-                                                      points[mtd_index],
-                                                      parameters["force"])))]
+                            constrain=constraint))]
     return mjobs
 
 def reaction_job(xtb,
@@ -232,7 +303,7 @@ def reaction_job(xtb,
         with open(output_folder + "/initial.xyz", "w") as f:
             f.write(initial_xyz)
 
-        points = np.linspace(low, high, npts)
+        points = driving_points(low, high, npts)
         forw = points[mtd_index:]
         # note: we want back to start at the same point as forward, otherwise
         # we get a lot more stretch on the backward trajectory and weird stuff
@@ -240,48 +311,67 @@ def reaction_job(xtb,
         back = points[:mtd_index+1][::-1]
 
         # We want to make sure to optimize the initial xyz so that both
-        # forward and backward start from optimized structures.
-        opt = xtb.optimize(output_folder + "initial.xyz",
-                           output_folder + "start.xyz",
-                           failout=output_folder + "/FAILED_OPT",
-                           level=parameters["optim"],
-                           xcontrol=dict(
-                               wall=parameters["wall"],
-                               constrain=make_constraint(
-                                   atoms,
-                                   forw[0], parameters["force"])))
-        opt()
-
-
-        # Forward reaction
-        fstructs, fe = stretch(
-            xtb, output_folder + "/start.xyz",
-            atoms, forw[0], forw[-1], len(forw),
-            parameters,
-            failout=output_folder + "/FAILED_FORWARD",
-            verbose=False)          # otherwise its way too verbose
-
-        # Backward reaction
+        # forward and backward start from optimized structures. Without a
+        # backward reaction this is redundant, as the scan starts by
+        # optimizing at forw[0] anyway, so we save an xtb run.
         if len(back)>1:
-            bstructs, be = stretch(
-                xtb, output_folder + "/start.xyz",
-                atoms, back[0], back[-1], len(back),
+            start = output_folder + "/start.xyz"
+            opt = xtb.optimize(output_folder + "initial.xyz",
+                               start,
+                               failout=output_folder + "/FAILED_OPT",
+                               level=parameters["optim"],
+                               xcontrol=dict(
+                                   wall=parameters["wall"],
+                                   constrain=make_constraint(
+                                       atoms,
+                                       forw[0], parameters["force"])))
+            opt()
+        else:
+            start = output_folder + "/initial.xyz"
+
+
+        # Forward and backward reactions both start from start and are
+        # otherwise independent.
+        def forward():
+            return stretch(
+                xtb, start,
+                atoms, forw[0], forw[-1], len(forw),
                 parameters,
-                failout=output_folder + "/FAILED_BACKWARD",
+                failout=output_folder + "/FAILED_FORWARD",
                 verbose=False)          # otherwise its way too verbose
 
-            # note, we don't need the first step which is the same as the
-            # first step of forward
-            bstructs = bstructs[1:]
-            be = be[1:]
+        def backward():
+            if len(back)>1:
+                bstructs, be = stretch(
+                    xtb, start,
+                    atoms, back[0], back[-1], len(back),
+                    parameters,
+                    failout=output_folder + "/FAILED_BACKWARD",
+                    verbose=False)          # otherwise its way too verbose
+                return bstructs, be
+            else:
+                return [], []
+
+        if parameters.get("react_concurrent", False) and len(back)>1:
+            # Run the backward reaction in a second thread while the forward
+            # reaction runs in this one.
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                bfuture = pool.submit(backward)
+                fstructs, fe = forward()
+                bstructs, be = bfuture.result()
         else:
-            bstructs = []
-            be = []
+            fstructs, fe = forward()
+            bstructs, be = backward()
 
-        # Dump forward reaction and backward reaction quantities
+        # Dump backward reaction (reversed) and forward reaction quantities.
+        # note, we don't need the first step of backward which is the same as
+        # the first step of forward.
+        nback = max(len(bstructs) - 1, 0)
         dump_succ_opt(output_folder,
-                      bstructs[::-1] + fstructs,
-                      be[::-1] + fe,
+                      itertools.chain(
+                          itertools.islice(reversed(bstructs), nback), fstructs),
+                      itertools.chain(
+                          itertools.islice(reversed(be), nback), fe),
                       split=False)
 
         # Now read results, optimize products and dump summary json
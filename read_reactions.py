@@ -1,5 +1,6 @@
 import io_utils
 import analysis
+import threading
 from analysis import *
 
 
@@ -20,11 +21,27 @@ if __name__ == "__main__":
                         action="store_true")
     parser.add_argument("--local", help="Use reaction-local barrier instead of TS energy.",
                         action="store_true")
+    parser.add_argument("-t", "--threads",
+                        help="Number of threads used to read reactions. Defaults to 8.",
+                        type=int, default=8)
+    parser.add_argument("-r", "--redo", help="Read every reaction again instead of"
+                        +" restarting from results_raw.pkl. Defaults to false.",
+                        action="store_true")
     args = parser.parse_args()
+    if args.threads < 1:
+        parser.error("-t/--threads must be at least 1")
     folder =args.folder
-    pathways = read_all_reactions(folder)
+    pathways = read_all_reactions(folder, restart=(not args.redo),
+                                  nthreads=args.threads)
     species = get_species_table(pathways, resolve_chiral=args.resolve_chiral)
 
+    # The species table is final, so we write it while the network is being
+    # analysed. The thread is not a daemon, so the file is completed even if
+    # we exit early below.
+    species_writer = threading.Thread(
+        target=species.to_csv, args=(folder + "/parsed_species.csv",))
+    species_writer.start()
+
 
     reactant, E = io_utils.traj2smiles(folder + "/init_opt.xyz", index=0,chiral=args.resolve_chiral)
     if args.all:
@@ -45,4 +62,4 @@ if __name__ == "__main__":
 
     # Finally, save parsed reaction network
     final.to_csv(folder + "/parsed_reactions.csv")
-    species.to_csv(folder + "/parsed_species.csv")
+    species_writer.join()
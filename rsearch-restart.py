@@ -1,8 +1,11 @@
 import os
 import argparse
-from rsearch import rsearch
+from rsearch import rsearch, clear_directory
 import yaml
-import shutil
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 # ========================== CLI INTERFACE ================================
 if __name__ == "__main__":
@@ -33,19 +36,17 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    # Load user parameters (or try at least)
+    # Load user parameters (or try at least). The file is read once, and its
+    # content is kept to be saved in the output directory.
     try:
         pfile = args.user_params
         with open(pfile, "r") as f:
-            user_params = yaml.load(f, Loader=yaml.Loader)
+            upfile = f.read()
     except IsADirectoryError:
         pfile = args.user_params + "/user.yaml"
         with open(pfile, "r") as f:
-            user_params = yaml.load(f, Loader=yaml.Loader)
-
-    # save user parameters
-    with open(pfile, "r") as f:
-        upfile = f.read()
+            upfile = f.read()
+    user_params = yaml.load(upfile, Loader=SafeLoader)
 
     # Prepare output files
     # --------------------
@@ -55,19 +56,18 @@ if __name__ == "__main__":
         # TODO: This and the -w flag is bad, we should fix it
         out_dir = os.path.dirname(pfile)
 
-    try:
-        os.makedirs(out_dir)
-    except FileExistsError:
+    if os.path.isdir(out_dir):
         print("Output directory exists:")
         if args.w:
             # Delete the directory, make it and restart
             print("   👍 but that's fine! -w flag is on.")
             print("   📁 %s is overwritten." % out_dir)
-            shutil.rmtree(out_dir)
-            os.makedirs(out_dir)
+            clear_directory(out_dir)
         else:
             print("   👎 -w flag is off -> exiting! 🚪")
             raise SystemExit(-1)
+    else:
+        os.makedirs(out_dir)
 
     # copy user params
     with open(out_dir +"/user.yaml", "w") as f:
@@ -83,9 +83,7 @@ if __name__ == "__main__":
         params_file = folder \
             + "/parameters/default.yaml"
 
-    with open(params_file, "r") as f:
-        default_params = yaml.load(f, Loader=yaml.Loader)
-
+    # rsearch() loads (and merges) the parameters in params_file itself
     out = rsearch(out_dir, params_file,
                   log_level=args.log_level,
                   nthreads=args.threads)
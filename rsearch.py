@@ -1,17 +1,46 @@
-import numpy as np
-import react
-from react_utils import stretch
-from analysis import postprocess_reaction
-import xtb_utils
-import io_utils
-from io_utils import pybel
 import os
 import shutil
+import threading
 import argparse
 from constants import hartree_ev, ev_kcalmol, bohr_ang
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
 from datetime import datetime
 
+def clear_directory(path):
+    """Replace the directory at path by an empty one.
+
+    The old directory is renamed out of the way and deleted in a background
+    thread, so that the run can start right away. If it can't be renamed, it
+    is deleted in place.
+    """
+    old = path.rstrip("/") + ".old.%i" % os.getpid()
+    try:
+        os.rename(path, old)
+    except OSError:
+        shutil.rmtree(path)
+    else:
+        # not a daemon, so that python waits for the deletion to finish
+        threading.Thread(target=shutil.rmtree, args=(old,),
+                         kwargs=dict(ignore_errors=True)).start()
+    os.makedirs(path)
+
+def load_params(path):
+    """Load a parameter file."""
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+def parameter_keys(path):
+    """Top-level keys of a parameter file.
+
+    The file is fully parsed, so that every valid yaml key (including quoted
+    ones) is found.
+    """
+    return list(load_params(path).keys())
+
 def cval(mol, atoms_i):
     atoms = [mol.GetAtom(i) for i in atoms_i]
     if len(atoms)==2:
@@ -22,6 +51,7 @@ def cval(mol, atoms_i):
         return mol.GetTorsion(*atoms)
 
 def init_xtb_driver(params, log_level=0):
+    import xtb_utils
     # todo : move this stuff to xtb_driver
     if "LOCALSCRATCH" in os.environ:
         scratch = os.environ["LOCALSCRATCH"]
@@ -63,15 +93,22 @@ def init_xtb_driver(params, log_level=0):
 
 def rsearch(out_dir, defaults,
             log_level=0, nthreads=1):
+    # The computational modules are only imported once a search actually
+    # runs, so that the command line (and --help) starts quickly.
+    import numpy as np
+    from scipy.spatial.distance import pdist
+    import react
+    from react_utils import stretch
+    import io_utils
+    from io_utils import pybel
 
     time_start = datetime.today().ctime()
 
 
     # load parameters
     with open(out_dir + "/user.yaml", "r") as f:
-        user_params = yaml.load(f, Loader=yaml.Loader)
-    with open(defaults, "r") as f:
-        params = yaml.load(f, Loader=yaml.Loader)
+        user_params = yaml.load(f, Loader=SafeLoader)
+    params = load_params(defaults)
 
     # Merge, replacing defaults with user parameters
     for key,val in user_params.items():
@@ -94,13 +131,10 @@ def rsearch(out_dir, defaults,
         # Load the molecule and compute its radius for the wall size
         at, pos = io_utils.xyz2numpy(params["xyz"])
         # Compute all interatomic distances
-        distances = []
-        for i in range(len(at)):
-            for j in range(i):
-                distances += [np.sqrt(np.sum((pos[i] - pos[j])**2))]
+        distances = pdist(pos)
 
         # Cavity is 1.5 x maximum distance in diameter
-        radius_bohr = 0.5 * max(distances) * params["cavity_scale"] \
+        radius_bohr = 0.5 * distances.max(initial=0.0) * params["cavity_scale"] \
             + 0.5 * params["cavity_offset"]
         radius_bohr /= bohr_ang
 
@@ -207,19 +241,21 @@ def rsearch(out_dir, defaults,
 
     # STEP 1: Initial generation of guess conformers
     # ----------------------------------------------------------------------------
-    react.generate_initial_structures(
+    init_structures = react.generate_initial_structures(
         xtb, out_dir, init1,
         atoms, low, high, npts,
         params)
 
-    # reset threading
+    # reset threading. The jobs that run nthreads xtb processes at the same
+    # time give each of them a single thread (see react.pool_driver).
     xtb.extra_args = xtb.extra_args[:-2]
 
     # Refinement and selection
     mtd_indices = react.select_initial_structures(
         xtb, out_dir, init1,
         atoms, low, high, npts,
-        params, nthreads=nthreads)
+        params, nthreads=nthreads,
+        structures=init_structures)
 
     # STEP 2: Metadynamics
     # ----------------------------------------------------------------------------
@@ -258,12 +294,11 @@ def rsearch(out_dir, defaults,
         meta = io_utils.metadata()
         meta["start"] = time_start
         meta["end"] =time_end
-        yaml.dump(io_utils.metadata(),f)
-        # Every parameter and then some
-        yaml.dump(params,f)
-        # dump extra stuff
-        yaml.dump({"nthreads":nthreads,
-                   "done_metadynamics_pts":list(mtd_indices)})
+        # then every parameter and then some, all in a single document
+        run = {**meta, **params}
+        run["nthreads"] = nthreads
+        run["done_metadynamics_pts"] = [int(i) for i in mtd_indices]
+        yaml.dump(run, f, Dumper=SafeDumper, sort_keys=False)
 
 
 
@@ -338,19 +373,18 @@ if __name__ == "__main__":
     # Prepare output files
     # --------------------
     out_dir = args.o
-    try:
-        os.makedirs(out_dir)
-    except FileExistsError:
+    if os.path.isdir(out_dir):
         print("Output directory exists:")
         if args.w:
             # Delete the directory, make it and restart
             print("   👍 but that's fine! -w flag is on.")
             print("   📁 %s is overwritten."% args.o)
-            shutil.rmtree(out_dir)
-            os.makedirs(out_dir)
+            clear_directory(out_dir)
         else:
             print("   👎 -w flag is off -> exiting! 🚪")
             raise SystemExit(-1)
+    else:
+        os.makedirs(out_dir)
 
 
     # Get default parameters
@@ -363,15 +397,14 @@ if __name__ == "__main__":
         params_file = folder \
             + "/parameters/default.yaml"
 
-    with open(params_file, "r") as f:
-        default_params = yaml.load(f, Loader=yaml.Loader)
+    # Only the names of the default parameters are needed here
+    default_keys = parameter_keys(params_file)
 
     # Save user-set command line parameters for reproducibility.
     user_params = {}
-    args_as_dict = vars(args)
-    for p in default_params.keys():
+    for p in default_keys:
         # arguments named the same as in the file
-        argvalue = args_as_dict.get(p, None)
+        argvalue = getattr(args, p, None)
         if argvalue:
             user_params[p] = argvalue
 
@@ -394,15 +427,18 @@ if __name__ == "__main__":
         user_params["driving_limits"] = [args.driving_from, args.driving_to]
 
     # Load the xyz file
+    import io_utils
     xyz,E = io_utils.traj2str(args.init_xyz, index=0)
+    # The whole file is built in memory and written at once. The xyz is
+    # written by hand so that it's formatted nicely.
+    user_yaml = (yaml.dump(user_params, Dumper=SafeDumper)
+                 + "xyz: |\n"
+                 # indent properly
+                 + "".join("  " + line.lstrip() + "\n"
+                           for line in xyz.split("\n"))
+                 + "\n")
     with open(out_dir + "/user.yaml", "w") as f:
-        yaml.dump(user_params,f)
-        # write xyz at the beginning by hand so that it's formatted nicely.
-        f.write("xyz: |\n")
-        for line in xyz.split("\n"):
-            # indent properly
-            f.write("  " + line.lstrip() + "\n")
-        f.write("\n")
+        f.write(user_yaml)
 
     if not args.dump:
         rsearch(out_dir, params_file,
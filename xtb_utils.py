@@ -3,6 +3,7 @@ import subprocess
 import shutil
 import os
 import tempfile
+import copy
 
 def make_xcontrol(xcontrol_dictionary, fn):
     """Transform a dictionary of parameters to an xTB xcontrol file.
@@ -50,7 +51,10 @@ class xtb_run:
                  restart=None,
                  failout=None,
                  delete=True,
-                 return_files=[]):
+                 return_files=[],
+                 geom_string=None,
+                 capture=None,
+                 env=None):
         """Build a container for an xtb run.
 
         Note: the xtb job is only *prepared* when the object is defined. To run
@@ -85,6 +89,16 @@ class xtb_run:
         will generate the file my_opt.xyz from the xtb optimized geometry
         xtbopt.xyz in the run directory.
 
+        geom_string (str) : if set, the geometry is written directly from this
+        string to the run directory, and geom_file is only used for its name.
+
+        capture (str) : name of a file in the run directory whose content is
+        read into self.output when close() is called. self.output is None if
+        that file was not produced.
+
+        env (dict) : environment of the xtb process. Defaults to None, i.e.
+        the environment of the current process.
+
         TODO UPDATE PARAMETERS
         """
         self.logfile = logfile
@@ -99,7 +113,12 @@ class xtb_run:
             self.out = open(self.dir + "/xtb.out", "w")
 
         self.err = open(self.dir + "/xtb.err", "w")
-        self.coord = shutil.copy(geom_file, self.dir)
+        if geom_string is None:
+            self.coord = shutil.copy(geom_file, self.dir)
+        else:
+            self.coord = self.dir + "/" + os.path.basename(geom_file)
+            with open(self.coord, "w") as f:
+                f.write(geom_string)
         for fn in other_input_files:
             shutil.copy(fn, self.dir)
 
@@ -109,6 +128,8 @@ class xtb_run:
 
         self.return_files = return_files   # list of files to take out when
                                            # run finishes
+        self.capture = capture
+        self.output = None
 
         self.args = [xtb]
         if xcontrol:
@@ -122,7 +143,8 @@ class xtb_run:
 
         self.kwargs = dict(stderr=self.err,
                            stdout=self.out,
-                           cwd=self.dir)
+                           cwd=self.dir,
+                           env=env)
 
         self.proc = None
 
@@ -187,6 +209,9 @@ class xtb_run:
         try:
             for file_in, file_out in self.return_files:
                 self.cp(file_in,file_out)
+            if self.capture:
+                with open(self.dir + "/" + self.capture, "r") as f:
+                    self.output = f.read()
             IOERROR = False
         except FileNotFoundError:
             IOERROR = True
@@ -231,7 +256,8 @@ class xtb_run:
 class xtb_driver:
     def __init__(self, path_to_xtb_binaries="",
                  delete=True, logfile=None,
-                 xtb_args=[], scratch="."):
+                 xtb_args=[], scratch=".",
+                 threads=None):
         """Utility driver for xtb runs.
 
         Methods include various kind of xtb runs.
@@ -249,6 +275,11 @@ class xtb_driver:
 
         scratch (str) : scratch directory for xtb runs, defaults to ".".
 
+        threads (int) : if set, the number of OpenMP/BLAS threads of each xtb
+        process. Set this to 1 when running many xtb processes in parallel to
+        avoid oversubscribing the cpus. Defaults to None, i.e. the environment
+        decides.
+
         """
         self.extra_args = xtb_args
         self.xtb_bin = path_to_xtb_binaries + "xtb"
@@ -256,6 +287,25 @@ class xtb_driver:
         self.scratchdir = scratch
         self.logfile = logfile
         self.delete=delete
+        self.threads = threads
+
+    def env(self):
+        """Environment of xtb processes, with the number of threads pinned
+        if self.threads is set."""
+        if self.threads is None:
+            return None
+        env = dict(os.environ)
+        for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            env[var] = str(self.threads)
+        return env
+
+    def with_threads(self, threads):
+        """Copy of this driver whose xtb processes use the given number of
+        threads, leaving this one untouched."""
+        new = copy.copy(self)
+        new.extra_args = list(self.extra_args)
+        new.threads = threads
+        return new
 
     def optimize(self,
                  geom_file,
@@ -265,7 +315,8 @@ class xtb_driver:
                  compute_hessian=False,
                  log=None,
                  failout=None,
-                 restart=None):
+                 restart=None,
+                 geom_string=None):
         """Optimize a molecule.
 
         Parameters:
@@ -273,7 +324,9 @@ class xtb_driver:
 
         geom_file (str) : path to the file containing the molecular geometry.
 
-        out_file (str): path to file where optimized geometry is saved.
+        out_file (str): path to file where optimized geometry is saved. If
+        None, the optimized geometry is instead read into the output attribute
+        of the job when it finishes.
 
         Optional Parameters:
         --------------------
@@ -281,6 +334,9 @@ class xtb_driver:
         xcontrol (dict) : xcontrol dictionary to be interpreted by
         make_xcontrol.
 
+        geom_string (str) : molecular geometry as an xyz string. If set,
+        geom_file is only used to name the input file in the run directory.
+
         level (str) : Optimization level. Defaults to "normal" if
         compute_hessian is False, or to "tight" otherwise.
 
@@ -304,9 +360,16 @@ class xtb_driver:
 
         file_ext = geom_file[-3:]
         if "scan" in xcontrol:
-            return_files=[("xtbscan.log", out_file)]
+            result = "xtbscan.log"
+        else:
+            result = "xtbopt." + file_ext
+
+        if out_file is None:
+            return_files = []
+            capture = result
         else:
-            return_files=[("xtbopt." + file_ext, out_file)]
+            return_files = [(result, out_file)]
+            capture = None
 
         if log:
             return_files += [("xtbopt.log", log)]
@@ -333,7 +396,10 @@ class xtb_driver:
                       delete=self.delete,
                       failout=failout,
                       logfile=self.logfile,
-                      return_files=return_files)
+                      return_files=return_files,
+                      geom_string=geom_string,
+                      capture=capture,
+                      env=self.env())
         return opt
 
     def metadyn(self,
@@ -376,35 +442,55 @@ class xtb_driver:
                      scratch=self.scratchdir,
                      failout=failout,
                      logfile=self.logfile,
-                     return_files=return_files)
+                     return_files=return_files,
+                     env=self.env())
         return md
 
     def cregen(self, reference_file, ensemble_file, out_file,
-               ewin=0.0, rthr=0.0, ethr=0.0, bthr=0.0):
+               ewin=0.0, rthr=0.0, ethr=0.0, bthr=0.0,
+               ensemble_string=None):
         """Sort and reduce an ensemble using CREGEN.
 
         Parameters:
         -----------
         TODO
 
-        geom_file (str) : path to the file containing the initial molecular
-        geometries.
+        reference_file (str) : path to the file containing the reference
+        geometry. If None, the ensemble itself is used as the reference.
 
         ensemble_file (str) : path to the file containing the ensemble.
 
-        out_file (str): path to file where results are saved.
+        out_file (str): path to file where results are saved. If None, the
+        sorted ensemble is instead read into the output attribute of the job
+        when it finishes.
 
         Optional Parameters:
         --------------------
         TODO
 
+        ensemble_string (str) : the ensemble as an xyz string. If set,
+        ensemble_file is only used to name the input file in the run
+        directory.
+
         Returns:
         --------
 
         cregen_run : The CREGEN job. Run using xtb_run().
 
         """
-        return_files=[("crest_ensemble.xyz", out_file)]
+        if out_file is None:
+            return_files = []
+            capture = "crest_ensemble.xyz"
+        else:
+            return_files=[("crest_ensemble.xyz", out_file)]
+            capture = None
+
+        if reference_file is None:
+            reference_file = ensemble_file
+            other_input_files = []
+        else:
+            other_input_files = [reference_file]
+
         cre = xtb_run(self.crest_bin,
                       ensemble_file,
                       os.path.basename(reference_file),
@@ -414,9 +500,12 @@ class xtb_driver:
                       "-bthr",str(bthr),
                       prefix="CRE",
                       before_geometry="-cregen",
-                      other_input_files=[reference_file],
+                      other_input_files=other_input_files,
                       delete=self.delete,
                       scratch=self.scratchdir,
                       logfile=self.logfile,
-                      return_files=return_files)
+                      return_files=return_files,
+                      geom_string=ensemble_string,
+                      capture=capture,
+                      env=self.env())
         return cre